@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Sustained `qdisc change` rate: `sudo tc` per command versus the persistent `tc -batch` process,
+used directly and through `exec_command` as with `pynetem --tc-batch`.
+
+Needs root (or password-less sudo) and a scratch interface, for example:
+    sudo ip link add pnbench type dummy && sudo ip link set pnbench up
+    python benchmarks/tc_batch.py -i pnbench -n 2000
+"""
+import os
+import sys
+import time
+from optparse import OptionParser
+
+# run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pynetem.pynetem import TcBatchSession, exec_command, enable_tc_batch
+
+
+_setup = {
+    'netem': 'qdisc replace dev {ETH} root netem delay 10ms',
+    'tbf': 'qdisc replace dev {ETH} root tbf rate 10mbit burst 32kbit latency 50ms',
+}
+_change = {
+    'netem': 'qdisc change dev {ETH} root netem delay {N}ms',
+    'tbf': 'qdisc change dev {ETH} root tbf rate {N}mbit burst 32kbit latency 50ms',
+}
+_teardown = 'sudo tc qdisc del dev {ETH} root'
+
+
+def _rate(count, seconds, results):
+    errors = sum(1 for status, msg in results if status == 'error')
+    return '{:>10.0f} updates/s  ({} errors)'.format(count / seconds, errors)
+
+
+def bench(eth, kind, count):
+    commands = [_change[kind].format(ETH=eth, N=1 + i % 100) for i in range(count)]
+    session = TcBatchSession()
+    session.execute([_setup[kind].format(ETH=eth)])
+
+    enable_tc_batch(False)
+    start = time.monotonic()
+    results = [exec_command('sudo tc ' + c) for c in commands[:max(1, count // 10)]]
+    print('{:<6} fork per command   {}'.format(kind, _rate(len(results), time.monotonic() - start, results)))
+
+    start = time.monotonic()
+    results = [session.execute([c])[0] for c in commands]
+    print('{:<6} batch, one by one  {}'.format(kind, _rate(count, time.monotonic() - start, results)))
+
+    # what pynetem itself does with --tc-batch: slots, timeout watchdog and tracing included
+    enable_tc_batch(True)
+    start = time.monotonic()
+    results = [exec_command('sudo tc ' + c) for c in commands]
+    print('{:<6} exec_command batch {}'.format(kind, _rate(count, time.monotonic() - start, results)))
+    enable_tc_batch(False)
+
+    start = time.monotonic()
+    results = session.execute(commands)
+    print('{:<6} batch, pipelined   {}'.format(kind, _rate(count, time.monotonic() - start, results)))
+
+    session.close()
+    exec_command(_teardown.format(ETH=eth))
+
+
+def main():
+    parser = OptionParser(usage="python benchmarks/tc_batch.py -i <interface> [-n count]")
+    parser.add_option('-i', '--interface', dest='interface', type='str', help="Scratch interface, its root qdisc is replaced")
+    parser.add_option('-n', '--count', dest='count', type='int', default=2000, help="Updates per run, default is 2000")
+    opts, args = parser.parse_args()
+    if not opts.interface:
+        parser.error('Must allocate one interface. For example: -i pnbench')
+    for kind in ('netem', 'tbf'):
+        bench(opts.interface, kind, opts.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import glob
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+from .pynetem import exec_command, put_file, logger
+
+
+builtin_distributions = ['normal', 'pareto', 'paretonormal']
+
+# same layout as iproute2's maketable: the standardized inverse CDF, scaled by 8192 and stored as int16
+_table_size = 4096
+_table_factor = 8192
+_table_version = 1
+_read_block = 16 * 1024 * 1024
+_separators = [b' ', b'\n', b'\t', b'\r']
+
+# where iproute2 may keep its tables, multiarch (Debian/Ubuntu) directories included
+_tc_lib_dirs = ['/usr/lib/tc', '/usr/lib64/tc', '/usr/lib/*/tc', '/lib/tc', '/lib64/tc', '/lib/*/tc', '/usr/share/tc']
+_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pynetem')
+_name_prefix = 'pynetem_'
+_name_re = re.compile(r'^pynetem_[0-9a-f]{16}$')
+
+_install_dist = 'sudo install -m 644 {SRC} {DST}'
+_ls_tc_lib = 'ls -d {DIR}/normal.dist'
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    sha.update('pynetem-dist-v{}-{}'.format(_table_version, _table_size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_read_block), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_samples(path):
+    """
+    Stream whitespace separated numbers from a file, parsing one large block at a time.
+    """
+    chunks = []
+    rest = b''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(_read_block)
+            if not block:
+                break
+            block = rest + block
+            # cut after the last separator, so no number is split across two blocks
+            cut = max(block.rfind(sep) for sep in _separators) + 1
+            block, rest = block[:cut], block[cut:]
+            chunks.append(_parse_block(block))
+        chunks.append(_parse_block(rest))
+    return np.concatenate(chunks)
+
+
+def _parse_block(block):
+    try:
+        return np.array(block.split(), dtype=np.bytes_).astype(np.float64)
+    except ValueError:
+        raise ValueError('Samples must be numbers separated by spaces or new lines')
+
+
+def make_table(samples):
+    """
+    Return (table, mean, std), netem scales the table by the jitter and adds the delay,
+    so `delay <mean> <std> distribution <name>` reproduces the samples.
+    """
+    samples = samples[np.isfinite(samples)]
+    if len(samples) < 2:
+        raise ValueError('Need at least two samples to build a distribution')
+    mean = float(samples.mean())
+    std = float(samples.std())
+    if std == 0:
+        raise ValueError('All samples are equal, there is no distribution to build')
+    probs = (np.arange(_table_size) + 0.5) / _table_size
+    quantiles = np.quantile(samples, probs)
+    table = np.clip(np.rint((quantiles - mean) / std * _table_factor), -32768, 32767).astype(np.int16)
+    return table, mean, std
+
+
+def format_table(table, comment):
+    lines = ['# {}'.format(comment)]
+    for i in range(0, len(table), 8):
+        lines.append(' '.join(str(v) for v in table[i:i + 8].tolist()))
+    return '\n'.join(lines) + '\n'
+
+
+def build_table(path, cache_dir=None):
+    """
+    Build the table for a sample file, or reuse the cached one with the same content hash.
+
+    Return (name, dist_path, meta), meta holds the mean and std of the samples.
+    """
+    cache_dir = cache_dir or _cache_dir
+    digest = file_digest(path)
+    name = _name_prefix + digest[:16]
+    dist_path = os.path.join(cache_dir, name + '.dist')
+    meta_path = os.path.join(cache_dir, name + '.json')
+    if os.path.exists(dist_path) and os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        logger.info('Use cached distribution table {}'.format(name))
+        return name, dist_path, meta
+
+    samples = read_samples(path)
+    table, mean, std = make_table(samples)
+    meta = {'name': name, 'sha256': digest, 'samples': int(len(samples)), 'mean': mean, 'std': std}
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_atomic(dist_path, format_table(table, 'pynetem distribution from {} samples, mean {:.6g}, std {:.6g}'.format(
+        meta['samples'], mean, std)))
+    # the meta file goes last, build_table only trusts a cache entry once it exists
+    _write_atomic(meta_path, json.dumps(meta))
+    logger.info('Built distribution table {} from {} samples'.format(name, meta['samples']))
+    return name, dist_path, meta
+
+
+def _write_atomic(path, content):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def tc_lib_dir(remote_ssh=False, host=None, username=None, password=None):
+    """
+    Return the directory holding the built-in tables (normal.dist), or None if there is none.
+    """
+    if not remote_ssh:
+        for each in _tc_lib_dirs:
+            found = sorted(glob.glob(os.path.join(each, 'normal.dist')))
+            if found:
+                return os.path.dirname(found[0])
+        return None
+    for each in _tc_lib_dirs:
+        # the remote shell expands the multiarch patterns
+        status, msg = exec_command(_ls_tc_lib.format(DIR=each), remote_ssh, host, username, password)
+        if status == 'success' and str(msg).strip():
+            return os.path.dirname(str(msg).split()[0])
+    return None
+
+
+def install_table(name, dist_path, remote_ssh=False, host=None, username=None, password=None):
+    lib_dir = tc_lib_dir(remote_ssh, host, username, password)
+    if lib_dir is None:
+        return 'error', 'Cannot find the tc distribution directory (no normal.dist in {})'.format(', '.join(_tc_lib_dirs))
+    dst = os.path.join(lib_dir, name + '.dist')
+    if not remote_ssh:
+        return exec_command(_install_dist.format(SRC=dist_path, DST=dst))
+    src = '/tmp/{}.dist'.format(name)
+    status, msg = put_file(dist_path, src, host, username, password)
+    if status == 'error':
+        return status, msg
+    return exec_command(_install_dist.format(SRC=src, DST=dst), remote_ssh, host, username, password)
+
+
+def is_known_distribution(name, remote_ssh=False):
+    if not isinstance(name, str):
+        return False
+    if name in builtin_distributions:
+        return True
+    if not _name_re.match(name):
+        return False
+    # the remote tc lib dir is not checked, tc itself reports a missing table
+    if remote_ssh:
+        return True
+    lib_dir = tc_lib_dir()
+    return lib_dir is not None and os.path.exists(os.path.join(lib_dir, name + '.dist'))
@@ -1,9 +1,13 @@
 import sys
 import re
+import json
 from optparse import OptionParser
 import pynetem
 from .pynetem import *
 from pynetem import web
+from pynetem import topology
+from pynetem import distribution
+from pynetem import tracing
 
 version = pynetem.__version__
 
@@ -37,7 +41,18 @@ def parse_options():
         '--distribution',
         dest='distribution',
         type='str',
-        help="Delay distribution, with three parameters: normal/pareto/paretonormal, and must use with --'delay' together",
+        help="Delay distribution, with three parameters: normal/pareto/paretonormal, and must use with --'delay' together. "
+             "Tables built by '--distribution-samples' can also be used by name",
+    )
+
+    parser.add_option(
+        '--distribution-samples',
+        dest='distribution_samples',
+        type='str',
+        help="Build a delay distribution table from a file of RTT or one-way delay samples in ms, "
+             "separated by spaces or new lines, and use it as '--distribution'. Without '-d', "
+             "the mean and standard deviation of the samples are used as delay and jitter. "
+             "For example: --distribution-samples=rtt.txt",
     )
 
     parser.add_option(
@@ -119,6 +134,22 @@ def parse_options():
         help="Clear the tc qdisc rules on dev"
     )
 
+    parser.add_option(
+        '--topology',
+        type='str',
+        dest='topology',
+        help="Build the namespaces, bridges and links described in a JSON topology file, "
+             "use with '-c' to tear it down. For example: --topology=lab.json"
+    )
+
+    parser.add_option(
+        '--workers',
+        type='int',
+        dest='workers',
+        default=16,
+        help="Number of namespaces configured in parallel by '--topology', default is 16."
+    )
+
     parser.add_option(
         '--web',
         action='store_true',
@@ -127,6 +158,56 @@ def parse_options():
         help="Run in web mode."
     )
 
+    parser.add_option(
+        '--tc-batch',
+        action='store_true',
+        dest='tc_batch',
+        default=False,
+        help="Send tc updates through one persistent 'tc -batch' process per host, "
+             "instead of starting 'sudo tc' for every command."
+    )
+
+    parser.add_option(
+        '--timeout',
+        type='float',
+        dest='timeout',
+        default=60,
+        help="Seconds a single tc/ip/brctl command may take before it is killed, 0 for no limit. default is 60."
+    )
+
+    parser.add_option(
+        '--request-timeout',
+        type='float',
+        dest='request_timeout',
+        default=120,
+        help="In web mode, seconds all commands of one API request may take together, 0 for no limit. default is 120."
+    )
+
+    parser.add_option(
+        '--max-concurrency',
+        type='int',
+        dest='max_concurrency',
+        default=32,
+        help="Maximum number of commands running at the same time. default is 32."
+    )
+
+    parser.add_option(
+        '--max-per-host',
+        type='int',
+        dest='max_per_host',
+        default=8,
+        help="Maximum number of commands running at the same time on one remote host (--host), "
+             "local commands are only bound by --max-concurrency. default is 8."
+    )
+
+    parser.add_option(
+        '--stats',
+        action='store_true',
+        dest='stats',
+        default=False,
+        help="In web mode, record qdisc and interface counters for /pynetem/stats/history."
+    )
+
     parser.add_option(
         '--port',
         type='int',
@@ -156,6 +237,30 @@ def parse_options():
         help="The host password"
     )
 
+    parser.add_option(
+        '--profile',
+        action='store_true',
+        dest='profile',
+        default=False,
+        help="Print how long each step took: validation, every tc command, and its subprocess or SSH phases."
+    )
+
+    parser.add_option(
+        '--trace-sample',
+        type='float',
+        dest='trace_sample',
+        default=0,
+        help="In web mode, trace this fraction (0-1) of API requests, see /pynetem/traces/recent. default is 0."
+    )
+
+    parser.add_option(
+        '--trace-export',
+        type='str',
+        dest='trace_export',
+        help="Also append finished traces to this file, as Chrome trace events if it ends with '.json', "
+             "otherwise as JSON lines. For example: --trace-export=traces.jsonl"
+    )
+
     # Version number (optparse gives you --version but we have to do it
     # ourselves to get -V too. sigh)
     parser.add_option(
@@ -173,16 +278,29 @@ def parse_options():
 
 def main():
     parser, options, arguments = parse_options()
-    _mark = 0
-
-    if options.version:
-        logger.info("pynetem %s" % (version,))
-        sys.exit(0)
-
-    if options.web:
-        web.start(options)
-        sys.exit(0)
-
+    if options.profile and options.web:
+        logger.error('Cannot use "--profile" and "--web" together, use "--trace-sample" in web mode.')
+        sys.exit(1)
+    if not 0 <= options.trace_sample <= 1:
+        logger.error('"--trace-sample" must be between 0 and 1')
+        sys.exit(1)
+    if options.trace_export and not (options.profile or options.trace_sample):
+        logger.error('"--trace-export" needs "--profile", or "--trace-sample" in web mode')
+        sys.exit(1)
+    if not options.profile:
+        run(options)
+        return
+    tracing.configure(enabled=True, sample_rate=1, export_path=options.trace_export)
+    try:
+        with tracing.trace('pynetem'):
+            run(options)
+    finally:
+        for t in tracing.recent(1):
+            logger.info('Profile:\n' + tracing.format_breakdown(t))
+
+
+@tracing.traced('validate')
+def validate_options(options):
     if not options.interface:
         logger.error('Must allocate one interfaces. For example: -i eth0')
         sys.exit(1)
@@ -219,6 +337,50 @@ def main():
         logger.error('Cannot user "--host" and "--web" together.')
         sys.exit(1)
 
+
+def run(options):
+    _mark = 0
+
+    if options.version:
+        logger.info("pynetem %s" % (version,))
+        sys.exit(0)
+
+    if options.timeout < 0 or options.max_concurrency < 1 or options.max_per_host < 1:
+        logger.error('"--timeout" must not be negative, "--max-concurrency" and "--max-per-host" must be at least 1')
+        sys.exit(1)
+    set_exec_limits(timeout=options.timeout, max_concurrency=options.max_concurrency, max_per_host=options.max_per_host)
+
+    if options.tc_batch:
+        enable_tc_batch()
+
+    if options.web:
+        web.start(options)
+        sys.exit(0)
+
+    if options.topology:
+        if options.host and not (options.username and options.password):
+            logger.error('Cannot use "--host" without "username" and "password"')
+            sys.exit(1)
+        if options.workers < 1:
+            logger.error('"--workers" must be at least 1')
+            sys.exit(1)
+        try:
+            topo = topology.load_topology(options.topology)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error('Invalid topology file: {}'.format(e))
+            sys.exit(1)
+        ssh = dict(remote_ssh=bool(options.host), host=options.host, username=options.username, password=options.password)
+        if options.clear:
+            status, report = topology.destroy_topology(topo, **ssh)
+        else:
+            status, report = topology.build_topology(topo, workers=options.workers, **ssh)
+        for err in report['errors']:
+            logger.error(err)
+        logger.info(json.dumps(report))
+        sys.exit(0 if status == 'success' else 1)
+
+    validate_options(options)
+
     eth = options.interface
     remote_ssh = False
     _host = None
@@ -235,19 +397,37 @@ def main():
         del_qdisc_root(eth=eth, remote_ssh=remote_ssh, host=_host, username=_username, password=_password, )
         sys.exit(0)
 
+    if options.distribution_samples:
+        if options.distribution:
+            logger.error('Cannot use "--distribution" and "--distribution-samples" together')
+            sys.exit(1)
+        try:
+            with tracing.span('build distribution'):
+                name, dist_path, meta = distribution.build_table(options.distribution_samples)
+        except (OSError, ValueError) as e:
+            logger.error('Cannot build distribution table: {}'.format(e))
+            sys.exit(1)
+        msg = distribution.install_table(name, dist_path, remote_ssh=remote_ssh, host=_host, username=_username, password=_password)
+        if msg[0] == 'error':
+            logger.error(msg[1])
+            sys.exit(1)
+        options.distribution = name
+        if not options.delay:
+            options.delay = '{:.3f}ms,{:.3f}ms'.format(meta['mean'], meta['std'])
+
     netem = dict()
     if options.delay:
         delay = re.split('[,;，；]', options.delay)
         netem['delay'] = ' '.join(delay)
         if options.distribution:
-            if options.distribution in ['normal', 'pareto', 'paretonormal']:
+            if distribution.is_known_distribution(options.distribution, remote_ssh):
                 if len(delay) >= 2:
                     netem['distribution'] = options.distribution
                 else:
                     logger.error('distribution specified but no latency and jitter values')
                     sys.exit(1)
             else:
-                logger.error('--distribution must be normal, pareto or paretonormal')
+                logger.error('--distribution must be normal, pareto, paretonormal or a table built by --distribution-samples')
                 sys.exit(1)
         if options.reorder:
             netem['reorder'] = ' '.join(re.split('[,;，；]', options.reorder))
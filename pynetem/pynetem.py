@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
+import re
+import time
+import atexit
+import socket
 import logging
+import threading
 import subprocess
+from contextlib import contextmanager
 import paramiko
 from paramiko.ssh_exception import SSHException
 
+from . import tracing
+
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -31,16 +39,38 @@ _brctl_addif = 'sudo brctl addif pynetem_bridge {ETH}'
 _brctl_delif = 'sudo brctl delif pynetem_bridge {ETH}'
 _btctl_stp = 'sudo brctl stp pynetem_bridge {STP}'
 
+_bad_chars = ["&", "|", ";", "$", ">", "<", "`", "\\", "!"]
+
+_tc_batch = ['sudo', 'tc', '-force', '-batch', '-']
+# always fails, its "Command failed -:<line>" on stderr marks the end of the previous command
+_tc_batch_sync = 'qdisc show dev pynetem-sync'
+_tc_batch_failed = re.compile(r'Command failed -:(\d+)')
+_tc_batch_verbs = ['add', 'del', 'delete', 'change', 'replace', 'link']
+_tc_batch_pipeline = 256
+
+_exec_limits = {'timeout': 60, 'max_concurrency': 32, 'max_per_host': 8}
+_exec_stats = {'executions': 0, 'in_flight': 0, 'timeouts': 0, 'queue_timeouts': 0,
+               'queue_wait_seconds': 0.0, 'queue_wait_max_seconds': 0.0}
+_exec_lock = threading.Lock()
+_exec_slots = threading.BoundedSemaphore(_exec_limits['max_concurrency'])
+_exec_host_slots = dict()
+_exec_local = threading.local()
+
+_tc_batch_enabled = False
+_tc_batch_sessions = dict()
+_tc_batch_lock = threading.Lock()
+
 
 class SSHAgent:
 
-    def __init__(self, ip, username, password, port=22):
+    def __init__(self, ip, username, password, port=22, timeout=None):
         self.ip = ip
         self.username = username
         self.password = password
         self.ssh = paramiko.SSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.ssh.connect(hostname=self.ip, port=port, username=self.username, password=self.password)
+        self.ssh.connect(hostname=self.ip, port=port, username=self.username, password=self.password,
+                         timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
 
     def __enter__(self):
         pass
@@ -48,8 +78,8 @@ class SSHAgent:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.ssh.close()
 
-    def remote_command(self, command):
-        stdin, stdout, stderr = self.ssh.exec_command(command)
+    def remote_command(self, command, timeout=None):
+        stdin, stdout, stderr = self.ssh.exec_command(command, timeout=timeout)
         logger.info('Send command - {ip}: {command}'.format(ip=self.ip, command=command))
         error = stderr.read().decode('utf-8')
         if error:
@@ -57,41 +87,468 @@ class SSHAgent:
         else:
             return 'success', stdout.read().decode('utf-8')
 
+    def put_file(self, local_path, remote_path, timeout=None):
+        sftp = self.ssh.open_sftp()
+        try:
+            sftp.get_channel().settimeout(timeout)
+            sftp.put(local_path, remote_path)
+        finally:
+            sftp.close()
+        logger.info('Put file - {ip}: {path}'.format(ip=self.ip, path=remote_path))
+
+    def remote_batch(self, command, script, timeout=None):
+        stdin, stdout, stderr = self.ssh.exec_command(command, timeout=timeout)
+        logger.info('Send batch - {ip}: {command} ({lines} lines)'.format(ip=self.ip, command=command, lines=script.count('\n')))
+        stdin.write(script)
+        stdin.channel.shutdown_write()
+        error = stderr.read().decode('utf-8')
+        if error:
+            return 'error', error
+        else:
+            return 'success', stdout.read().decode('utf-8')
 
-def exec_command(command, remote_ssh=False, host=None, username=None, password=None):
-    bad_chars = ["&", "|", ";", "$", ">", "<", "`", "\\", "!"]
-    if any([char in command for char in bad_chars]):
-        return 'error', 'Illegal characters in command that may result in arbitrary execution'
 
-    if not remote_ssh:
-        _exec = subprocess.Popen(command.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        info, err = _exec.communicate()
-        if err:
-            return 'error', err.decode('utf-8')
+def set_exec_limits(timeout=None, max_concurrency=None, max_per_host=None):
+    """
+    Configure the per-operation timeout (seconds, 0 for none) and how many commands may run at once,
+    in total and per host.
+    """
+    global _exec_slots
+    with _exec_lock:
+        if timeout is not None:
+            _exec_limits['timeout'] = timeout
+        if max_concurrency is not None:
+            _exec_limits['max_concurrency'] = max_concurrency
+            _exec_slots = threading.BoundedSemaphore(max_concurrency)
+        if max_per_host is not None:
+            _exec_limits['max_per_host'] = max_per_host
+            _exec_host_slots.clear()
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Every command run by this thread inside the block has to finish within `seconds` in total.
+    """
+    previous = getattr(_exec_local, 'deadline', None)
+    _exec_local.deadline = time.monotonic() + seconds
+    if previous is not None:
+        _exec_local.deadline = min(previous, _exec_local.deadline)
+    try:
+        yield
+    finally:
+        _exec_local.deadline = previous
+
+
+def _remaining():
+    timeout = _exec_limits['timeout'] or None
+    request_deadline = getattr(_exec_local, 'deadline', None)
+    if request_deadline is not None:
+        left = request_deadline - time.monotonic()
+        timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+
+def _acquire_slot(host):
+    """
+    Wait for a global slot, and a per-host one for remote hosts (`host` is None for local commands).
+    Return the semaphores taken, or None on timeout.
+    """
+    with _exec_lock:
+        if host is None:
+            slots = (_exec_slots,)
         else:
-            return 'success', info.decode('utf-8')
+            if host not in _exec_host_slots:
+                _exec_host_slots[host] = threading.BoundedSemaphore(_exec_limits['max_per_host'])
+            slots = (_exec_slots, _exec_host_slots[host])
+    start = time.monotonic()
+    acquired = []
+    for slot in slots:
+        timeout = _remaining()
+        if not slot.acquire(timeout=None if timeout is None else max(timeout, 0)):
+            for each in acquired:
+                each.release()
+            _count_exec(queue_timeouts=1, queue_wait=time.monotonic() - start)
+            return None
+        acquired.append(slot)
+    _count_exec(executions=1, in_flight=1, queue_wait=time.monotonic() - start)
+    return slots
+
+
+def _release_slot(slots):
+    for slot in slots:
+        slot.release()
+    _count_exec(in_flight=-1)
+
+
+def _count_exec(executions=0, in_flight=0, timeouts=0, queue_timeouts=0, queue_wait=None):
+    with _exec_lock:
+        _exec_stats['executions'] += executions
+        _exec_stats['in_flight'] += in_flight
+        _exec_stats['timeouts'] += timeouts
+        _exec_stats['queue_timeouts'] += queue_timeouts
+        if queue_wait is not None:
+            _exec_stats['queue_wait_seconds'] += queue_wait
+            _exec_stats['queue_wait_max_seconds'] = max(_exec_stats['queue_wait_max_seconds'], queue_wait)
+
+
+def exec_stats():
+    with _exec_lock:
+        res = dict(_exec_stats)
+        res.update(_exec_limits)
+    waited = res['executions'] + res['queue_timeouts']
+    res['queue_wait_avg_seconds'] = res['queue_wait_seconds'] / waited if waited else 0
+    return res
+
+
+def _timed_out(timeout, command):
+    _count_exec(timeouts=1)
+    return 'error', 'Timed out after {:.1f}s: {}'.format(timeout or 0, command)
+
+
+def _run_local(argv, script=None):
+    timeout = _remaining()
+    if timeout is not None and timeout <= 0:
+        return _timed_out(0, ' '.join(argv))
+    with tracing.span('spawn'):
+        _exec = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with tracing.span('wait', pid=_exec.pid):
+            info, err = _exec.communicate(None if script is None else script.encode('utf-8'), timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # sudo relays SIGTERM to the command, SIGKILL would only kill sudo itself
+        _exec.terminate()
+        try:
+            _exec.wait(1)
+        except subprocess.TimeoutExpired:
+            _exec.kill()
+            _exec.wait()
+        return _timed_out(timeout, ' '.join(argv))
+    if err:
+        return 'error', err.decode('utf-8')
     else:
+        return 'success', info.decode('utf-8')
+
+
+def _run_remote(command, host, username, password, script=None):
+    timeout = _remaining()
+    if timeout is not None and timeout <= 0:
+        return _timed_out(0, command)
+    try:
+        with tracing.span('ssh connect', host=host):
+            ssh = SSHAgent(ip=host, username=username, password=password, timeout=timeout)
+        with ssh, tracing.span('ssh exec', host=host):
+            if script is None:
+                output = ssh.remote_command(command, timeout=_remaining())
+            else:
+                output = ssh.remote_batch(command, script, timeout=_remaining())
+    except socket.timeout:
+        output = _timed_out(timeout, command)
+    except SSHException as e:
+        output = 'error', e
+    return output
+
+
+def exec_command(command, remote_ssh=False, host=None, username=None, password=None):
+    if any([char in command for char in _bad_chars]):
+        return 'error', 'Illegal characters in command that may result in arbitrary execution'
+
+    with tracing.span('exec', command=command) as span:
+        with tracing.span('queue'):
+            slots = _acquire_slot(host if remote_ssh else None)
+        if slots is None:
+            span.set(status='queue timeout')
+            return 'error', 'Timed out waiting for a free execution slot: {}'.format(command)
+        try:
+            if _tc_batch_enabled and _is_tc_update(command):
+                session = get_tc_batch(remote_ssh, host, username, password)
+                output = session.execute([command.split(' ', 2)[2]], timeout=_remaining())[0]
+            elif not remote_ssh:
+                output = _run_local(command.split())
+            else:
+                output = _run_remote(command, host, username, password)
+        finally:
+            _release_slot(slots)
+        span.set(status=output[0])
+        return output
+
+
+def put_file(local_path, remote_path, host, username, password):
+    """
+    Copy a local file to the host over SFTP, within the same slots and timeout as commands.
+    """
+    command = 'put {}'.format(remote_path)
+    with tracing.span('put file', host=host, path=remote_path) as span:
+        with tracing.span('queue'):
+            slots = _acquire_slot(host)
+        if slots is None:
+            span.set(status='queue timeout')
+            return 'error', 'Timed out waiting for a free execution slot: {}'.format(command)
         try:
-            ssh = SSHAgent(ip=host, username=username, password=password)
-            with ssh:
-                output = ssh.remote_command(command)
-        except SSHException as e:
+            timeout = _remaining()
+            if timeout is not None and timeout <= 0:
+                output = _timed_out(0, command)
+            else:
+                with tracing.span('ssh connect', host=host):
+                    ssh = SSHAgent(ip=host, username=username, password=password, timeout=timeout)
+                with ssh:
+                    ssh.put_file(local_path, remote_path, timeout=_remaining())
+                output = 'success', ''
+        except socket.timeout:
+            output = _timed_out(timeout, command)
+        except (SSHException, OSError) as e:
             output = 'error', e
+        finally:
+            _release_slot(slots)
+        span.set(status=output[0])
+        return output
+
+
+def exec_batch(tool, lines, netns=None, remote_ssh=False, host=None, username=None, password=None):
+    """
+    Run many `ip` or `tc` commands through one `<tool> -force -batch -` process.
+
+    `lines` are the commands without the leading tool name, e.g. 'link set eth0 up'.
+    With `netns`, the whole batch runs inside that network namespace.
+    """
+    if tool not in ('ip', 'tc'):
+        return 'error', 'Batch mode only supports ip and tc'
+    for line in lines:
+        if '\n' in line or any([char in line for char in _bad_chars]):
+            return 'error', 'Illegal characters in command that may result in arbitrary execution'
+    if len(lines) == 0:
+        return 'success', ''
+    command = ['sudo', tool, '-force']
+    if netns:
+        command.extend(['-n', netns])
+    command.extend(['-batch', '-'])
+    script = '\n'.join(lines) + '\n'
+
+    with tracing.span('exec batch', command=' '.join(command), lines=len(lines)) as span:
+        with tracing.span('queue'):
+            slots = _acquire_slot(host if remote_ssh else None)
+        if slots is None:
+            span.set(status='queue timeout')
+            return 'error', 'Timed out waiting for a free execution slot: {}'.format(' '.join(command))
+        try:
+            if not remote_ssh:
+                output = _run_local(command, script)
+            else:
+                output = _run_remote(' '.join(command), host, username, password, script)
+        finally:
+            _release_slot(slots)
+        span.set(status=output[0])
         return output
 
 
+def _is_tc_update(command):
+    words = command.split()
+    return len(words) >= 4 and words[:2] == ['sudo', 'tc'] and words[3] in _tc_batch_verbs
+
+
+class TcBatchSession:
+    """
+    A long-lived `tc -force -batch -` process, on this host or over one SSH session.
+
+    Every command is followed by `_tc_batch_sync`, so the stderr lines between two
+    sync markers belong to exactly one command.
+    """
+
+    def __init__(self, remote_ssh=False, host=None, username=None, password=None):
+        self.remote_ssh = remote_ssh
+        self.host = host
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+        self.proc = None
+        self.agent = None
+        self.stdin = None
+        self.stderr = None
+        self.lineno = 0
+        self.restarts = -1
+        self.timed_out = False
+        # one watchdog thread per session, execute() only moves its deadline
+        self.watch = threading.Condition()
+        self.watchdog = None
+        self.deadline = None
+        self.watch_until = None
+        self.shut = False
+
+    def start(self):
+        self.close()
+        if not self.remote_ssh:
+            self.proc = subprocess.Popen(_tc_batch, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                         universal_newlines=True, bufsize=1)
+            self.stdin, self.stderr = self.proc.stdin, self.proc.stderr
+        else:
+            self.agent = SSHAgent(ip=self.host, username=self.username, password=self.password, timeout=_remaining())
+            self.stdin, _, self.stderr = self.agent.ssh.exec_command(' '.join(_tc_batch))
+        self.lineno = 0
+        self.restarts += 1
+        logger.info('Start tc batch - {ip}{restart}'.format(
+            ip=self.host or 'localhost', restart=' (restart {})'.format(self.restarts) if self.restarts else ''))
+
+    def alive(self):
+        if self.proc is not None:
+            return self.proc.poll() is None
+        if self.agent is not None:
+            return not self.stdin.channel.exit_status_ready()
+        return False
+
+    def close(self):
+        try:
+            if self.stdin is not None:
+                self.stdin.close()
+            if self.proc is not None:
+                self.proc.wait()
+            if self.agent is not None:
+                self.agent.ssh.close()
+        except (OSError, SSHException):
+            pass
+        self.proc, self.agent, self.stdin, self.stderr = None, None, None, None
+
+    def execute(self, commands, timeout=None):
+        """
+        Run tc commands (without the leading 'tc'), return one (status, msg) per command.
+
+        After `timeout` seconds the process is stopped, unfinished commands fail and the next call restarts it.
+        """
+        results = []
+        with self.lock, tracing.span('tc batch', host=self.host or 'localhost', commands=len(commands)):
+            self.timed_out = False
+            try:
+                if not self.alive():
+                    self.start()
+                if timeout:
+                    self._arm(timeout)
+                for i in range(0, len(commands), _tc_batch_pipeline):
+                    chunk = commands[i:i + _tc_batch_pipeline]
+                    self.stdin.write(''.join('{}\n{}\n'.format(c, _tc_batch_sync) for c in chunk))
+                    self.stdin.flush()
+                    results.extend(self._read_result(c) for c in chunk)
+            except (OSError, EOFError, ValueError, SSHException) as e:
+                logger.error('tc batch - {ip}: {e}'.format(ip=self.host or 'localhost', e='timed out' if self.timed_out else e))
+                self.close()
+                if self.timed_out:
+                    _count_exec(timeouts=1)
+                    reason = 'Timed out after {:.1f}s'.format(timeout)
+                else:
+                    reason = 'tc batch process died'
+                results.extend(('error', '{} before "tc {}" finished'.format(reason, c)) for c in commands[len(results):])
+            finally:
+                if timeout:
+                    with self.watch:
+                        self.deadline = None
+        return results
+
+    def _arm(self, timeout):
+        with self.watch:
+            self.deadline = time.monotonic() + timeout
+            if self.watchdog is None:
+                self.watchdog = threading.Thread(target=self._watch, daemon=True)
+                self.watchdog.start()
+            # a watchdog sleeping towards an earlier deadline re-checks by itself when it wakes up
+            if self.watch_until is None or self.deadline < self.watch_until:
+                self.watch.notify()
+
+    def _watch(self):
+        with self.watch:
+            while not self.shut:
+                if self.deadline is None:
+                    self.watch_until = None
+                    self.watch.wait()
+                    continue
+                left = self.deadline - time.monotonic()
+                if left > 0:
+                    self.watch_until = self.deadline
+                    self.watch.wait(left)
+                    continue
+                self.deadline = None
+                self._abort()
+
+    def shutdown(self):
+        with self.watch:
+            self.shut = True
+            self.watch.notify()
+        with self.lock:
+            self.close()
+
+    def _abort(self):
+        self.timed_out = True
+        try:
+            if self.proc is not None:
+                self.proc.terminate()
+            if self.agent is not None:
+                self.agent.ssh.close()
+        except OSError:
+            pass
+
+    def _read_result(self, command):
+        op_line, sync_line = self.lineno + 1, self.lineno + 2
+        self.lineno += 2
+        failed = False
+        errors = []
+        while True:
+            line = self.stderr.readline()
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line:
+                raise EOFError('tc batch process exited')
+            m = _tc_batch_failed.search(line)
+            if m and int(m.group(1)) == sync_line:
+                break
+            if m and int(m.group(1)) == op_line:
+                failed = True
+            elif 'pynetem-sync' not in line:
+                errors.append(line)
+        if failed:
+            return 'error', 'tc {}: {}'.format(command, ''.join(errors).strip())
+        return 'success', ''.join(errors)
+
+
+def get_tc_batch(remote_ssh=False, host=None, username=None, password=None):
+    key = (host, username) if remote_ssh else None
+    with _tc_batch_lock:
+        if key not in _tc_batch_sessions:
+            _tc_batch_sessions[key] = TcBatchSession(remote_ssh, host, username, password)
+        return _tc_batch_sessions[key]
+
+
+def enable_tc_batch(enabled=True):
+    """
+    Send every tc update through one persistent `tc -batch` process per host, instead of `sudo tc` per command.
+    """
+    global _tc_batch_enabled
+    _tc_batch_enabled = enabled
+    if not enabled:
+        close_tc_batch()
+
+
+def close_tc_batch():
+    with _tc_batch_lock:
+        for session in _tc_batch_sessions.values():
+            session.shutdown()
+        _tc_batch_sessions.clear()
+
+
+atexit.register(close_tc_batch)
+
+
+@tracing.traced()
 def get_qdisc_ls(eth, remote_ssh=False, host=None, username=None, password=None):
     command = _tc_qdisc_ls.format(ETH=eth)
     msg = exec_command(command, remote_ssh, host, username, password)
     return msg
 
 
+@tracing.traced()
 def del_qdisc_root(eth, remote_ssh=False, host=None, username=None, password=None):
     command = _tc_del_qdisc_root.format(ETH=eth)
     msg = exec_command(command, remote_ssh, host, username, password)
     return msg
 
 
+@tracing.traced()
 def add_qdisc_root(eth, remote_ssh=False, host=None, username=None, password=None, **kwargs):
     del_qdisc_root(eth, remote_ssh, host, username, password)
     command = _tc_add_qdisc_root_netem.format(ETH=eth)
@@ -103,6 +560,7 @@ def add_qdisc_root(eth, remote_ssh=False, host=None, username=None, password=Non
     return msg
 
 
+@tracing.traced()
 def add_qdisc_rate_control(eth, rate, buffer=1600, limit=3000, remote_ssh=False, host=None, username=None, password=None, **kwargs):
     buffer = 1600 if buffer is None else buffer
     limit = 3000 if limit is None else limit
@@ -124,6 +582,7 @@ def add_qdisc_rate_control(eth, rate, buffer=1600, limit=3000, remote_ssh=False,
     return msg
 
 
+@tracing.traced()
 def add_qdisc_traffic(eth, rate, buffer=1600, limit=3000, cidr=None, remote_ssh=False, host=None, username=None, password=None, **kwargs):
     buffer = 1600 if buffer is None else buffer
     limit = 3000 if limit is None else limit
@@ -153,6 +612,7 @@ def add_qdisc_traffic(eth, rate, buffer=1600, limit=3000, cidr=None, remote_ssh=
     return msg
 
 
+@tracing.traced()
 def brctl_addbr(stp='on', remote_ssh=False, host=None, username=None, password=None):
     exec_command(_brctl_delbr, remote_ssh, host, username, password)
     msg = exec_command(_brctl_addbr, remote_ssh, host, username, password)
@@ -162,16 +622,19 @@ def brctl_addbr(stp='on', remote_ssh=False, host=None, username=None, password=N
     return msg
 
 
+@tracing.traced()
 def brctl_addif(eth, remote_ssh=False, host=None, username=None, password=None):
     msg = exec_command(_brctl_addif.format(ETH=eth), remote_ssh, host, username, password)
     return msg
 
 
+@tracing.traced()
 def brctl_delbr(remote_ssh=False, host=None, username=None, password=None):
     msg = exec_command(_brctl_delbr, remote_ssh, host, username, password)
     return msg
 
 
+@tracing.traced()
 def brctl_delif(eth, remote_ssh=False, host=None, username=None, password=None):
     msg = exec_command(_brctl_delif.format(ETH=eth), remote_ssh, host, username, password)
     return msg
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import time
+import threading
+
+import numpy as np
+
+from .pynetem import _run_local, logger
+
+
+# (step in seconds, span in seconds) from finest to coarsest, the sampler runs at the finest step
+_default_tiers = [(0.1, 600), (1, 3600), (10, 86400)]
+_max_buckets = 10000
+_max_series_per_eth = 16
+
+_link_fields = ['rx_bytes', 'rx_packets', 'rx_dropped', 'tx_bytes', 'tx_packets', 'tx_dropped']
+_qdisc_fields = ['bytes', 'packets', 'dropped', 'overlimits', 'requeues', 'backlog_bytes', 'backlog_packets']
+_qdisc_gauges = ['backlog_bytes', 'backlog_packets']
+
+# reading statistics needs no privileges, so skip sudo and its PAM cost on every tick
+# JSON output gives exact integers, the text output rounds backlog to e.g. "2Kb"
+_tc_qdisc_stats = 'tc -s -j qdisc show'
+_sys_net_stats = '/sys/class/net/{ETH}/statistics/{FIELD}'
+_qdisc_json_fields = ['bytes', 'packets', 'drops', 'overlimits', 'requeues', 'backlog', 'qlen']
+
+
+class RingBuffer:
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.ts = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, width), dtype=np.float64)
+        self.head = 0
+        self.size = 0
+
+    def append(self, ts, row):
+        self.ts[self.head] = ts
+        self.values[self.head] = row
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def update_last(self, ts, row, peaks=()):
+        """
+        Overwrite the newest row, keeping the maximum of the `peaks` columns.
+        """
+        last = self.head - 1
+        row = np.asarray(row, dtype=np.float64)
+        kept = np.maximum(self.values[last, peaks], row[peaks])
+        self.ts[last] = ts
+        self.values[last] = row
+        self.values[last, peaks] = kept
+
+    @property
+    def first_ts(self):
+        return self.ts[self.head if self.size == self.capacity else 0]
+
+    @property
+    def last_ts(self):
+        return self.ts[self.head - 1]
+
+    def window(self, start, end):
+        """
+        Return copies of the (ts, values) rows with start <= ts <= end, oldest first.
+        """
+        if self.size < self.capacity:
+            ts, values = self.ts[:self.size], self.values[:self.size]
+        else:
+            ts = np.concatenate((self.ts[self.head:], self.ts[:self.head]))
+            values = np.concatenate((self.values[self.head:], self.values[:self.head]))
+        lo = np.searchsorted(ts, start, side='left')
+        hi = np.searchsorted(ts, end, side='right')
+        return ts[lo:hi].copy(), values[lo:hi].copy()
+
+
+class SeriesHistory:
+    """
+    Multi-resolution history of one counter set, every tier is a fixed-size ring buffer.
+    """
+
+    def __init__(self, fields, gauges=None, tiers=None):
+        self.fields = fields
+        self.gauges = [fields.index(g) for g in gauges or []]
+        self.tiers = [(step, RingBuffer(int(round(span / step)), len(fields))) for step, span in tiers or _default_tiers]
+        self.updated = 0
+
+    def append(self, ts, row):
+        self.updated = ts
+        for step, ring in self.tiers:
+            if ring.size == 0 or _bucket(ts, step) > _bucket(ring.last_ts, step):
+                ring.append(ts, row)
+            else:
+                # one row per bucket: the latest counters, and gauges at their peak so far
+                ring.update_last(ts, row, self.gauges)
+
+    def _pick_tier(self, start, step):
+        """
+        The finest tier reaching back to `start`, preferring steps no coarser than the query.
+        When none reaches that far, the one going back the furthest.
+        """
+        filled = [t for t in self.tiers if t[1].size] or self.tiers[:1]
+        covering = [t for t in filled if t[1].first_ts <= start]
+        if covering:
+            return next((t for t in covering if t[0] <= step), covering[0])
+        return min(filled, key=lambda t: t[1].first_ts)
+
+    def query(self, start, end, step):
+        tier_step, ring = self._pick_tier(start, step)
+        ts, values = ring.window(start, end)
+        nb = int(np.ceil((end - start) / step))
+        edges = start + step * np.arange(1, nb + 1)
+
+        # counters: last sample of each bucket, and the rate between consecutive buckets
+        idx = np.searchsorted(ts, edges, side='right') - 1
+        valid = (idx >= 0) & (ts[np.maximum(idx, 0)] > edges - step) if len(ts) else np.zeros(nb, dtype=bool)
+        last = np.full((nb, len(self.fields)), np.nan)
+        last_ts = np.full(nb, np.nan)
+        last[valid] = values[idx[valid]]
+        last_ts[valid] = ts[idx[valid]]
+        rate = np.full_like(last, np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rate[1:] = (last[1:] - last[:-1]) / (last_ts[1:] - last_ts[:-1])[:, None]
+
+        # gauges: maximum within each bucket
+        peak = np.full((nb, len(self.gauges)), np.nan)
+        if len(ts) and self.gauges:
+            # same (edge - step, edge] buckets as the counters
+            bucket = np.minimum(np.ceil((ts - start) / step).astype(np.int64) - 1, nb - 1)
+            inside = bucket >= 0
+            np.fmax.at(peak, bucket[inside], values[inside][:, self.gauges])
+
+        series = dict()
+        for i, field in enumerate(self.fields):
+            if i in self.gauges:
+                series[field] = _to_list(peak[:, self.gauges.index(i)])
+            else:
+                series[field] = _to_list(last[:, i])
+                series[field + '_per_sec'] = _to_list(rate[:, i])
+        return {'resolution': tier_step, 'samples': int(len(ts)), 'series': series}
+
+
+class StatsStore:
+
+    def __init__(self, tiers=None):
+        self.tiers = tiers or _default_tiers
+        self.history = dict()
+        self.lock = threading.Lock()
+
+    def record(self, eth, key, fields, ts, row, gauges=None):
+        with self.lock:
+            per_eth = self.history.setdefault(eth, dict())
+            if key not in per_eth:
+                if len(per_eth) >= _max_series_per_eth:
+                    # qdisc handles change on every rule update, forget the one idle the longest
+                    del per_eth[min(per_eth, key=lambda k: per_eth[k].updated)]
+                per_eth[key] = SeriesHistory(fields, gauges, self.tiers)
+            per_eth[key].append(ts, row)
+
+    def query(self, eth, start, end, step):
+        with self.lock:
+            per_eth = dict(self.history.get(eth, dict()))
+            res = dict((key, history.query(start, end, step)) for key, history in per_eth.items())
+        res_t = start + step * np.arange(1, int(np.ceil((end - start) / step)) + 1)
+        return {'eth': eth, 'from': start, 'to': end, 'step': step, 't': res_t.tolist(), 'stats': res}
+
+
+class StatsSampler(threading.Thread):
+
+    def __init__(self, store, interfaces, interval=None):
+        super().__init__(daemon=True)
+        self.store = store
+        self.interfaces = interfaces
+        self.interval = interval or store.tiers[0][0]
+        self.stopped = threading.Event()
+
+    def run(self):
+        next_tick = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                self.sample(time.time())
+            except Exception as e:
+                logger.error('Stats sampling failed: {}'.format(e))
+            next_tick += self.interval
+            self.stopped.wait(max(0, next_tick - time.monotonic()))
+
+    def stop(self):
+        self.stopped.set()
+
+    def sample(self, ts):
+        for eth in self.interfaces:
+            row = read_link_stats(eth)
+            if row is not None:
+                self.store.record(eth, 'link', _link_fields, ts, row)
+        # read-only and local: bypass the execution slots, so sampling neither competes with
+        # API requests nor shows up in exec_stats()
+        status, msg = _run_local(_tc_qdisc_stats.split())
+        if status == 'error':
+            return
+        for eth, key, row in parse_qdisc_stats(msg):
+            if eth in self.interfaces:
+                self.store.record(eth, key, _qdisc_fields, ts, row, gauges=_qdisc_gauges)
+
+
+def read_link_stats(eth):
+    row = []
+    try:
+        for field in _link_fields:
+            with open(_sys_net_stats.format(ETH=eth, FIELD=field)) as f:
+                row.append(int(f.read()))
+    except (OSError, ValueError):
+        return None
+    return row
+
+
+def parse_qdisc_stats(output):
+    """
+    Parse `tc -s -j qdisc show`, yield (eth, 'qdisc <kind> <handle>', row) in `_qdisc_fields` order.
+    """
+    for qdisc in json.loads(output or '[]'):
+        if 'dev' not in qdisc or 'bytes' not in qdisc:
+            continue
+        row = [int(qdisc.get(field, 0)) for field in _qdisc_json_fields]
+        yield qdisc['dev'], 'qdisc {} {}'.format(qdisc.get('kind'), qdisc.get('handle')), row
+
+
+def _bucket(ts, step):
+    # 1250.0 // 0.1 is 12499.0, nudge so float error does not merge neighbouring samples
+    return math.floor(ts / step + 1e-6)
+
+
+def _to_list(arr):
+    return [None if np.isnan(v) else float(v) for v in arr.tolist()]
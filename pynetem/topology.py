@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .pynetem import exec_batch, logger
+from . import tracing
+
+
+_netem_keys = ['delay', 'distribution', 'reorder', 'loss', 'duplicate', 'corrupt', 'rate', 'limit']
+
+_ip_netns_add = 'netns add {NS}'
+_ip_netns_del = 'netns del {NS}'
+_ip_bridge_add = 'link add {BR} type bridge stp_state {STP}'
+_ip_link_up = 'link set dev {ETH} up'
+_ip_link_del = 'link del dev {ETH}'
+_ip_veth_add = 'link add {A}{A_NS} type veth peer name {B}{B_NS}'
+_ip_link_master = 'link set dev {ETH} master {BR} up'
+_ip_addr_add = 'addr add {ADDR} dev {ETH}'
+_tc_netem = 'qdisc replace dev {ETH} root netem'
+
+
+class Topology:
+
+    def __init__(self, nodes, bridges, links, profiles=None):
+        self.nodes = nodes
+        self.bridges = bridges
+        self.links = links
+        self.profiles = profiles or dict()
+
+    @classmethod
+    def from_dict(cls, data):
+        nodes = [n if isinstance(n, str) else n['name'] for n in data.get('nodes', [])]
+        bridges = dict()
+        for b in data.get('bridges', []):
+            if isinstance(b, str):
+                bridges[b] = 'off'
+            else:
+                bridges[b['name']] = b.get('stp', 'off')
+        profiles = data.get('profiles', dict())
+        links = []
+        for idx, link in enumerate(data.get('links', [])):
+            profile = link.get('profile')
+            if isinstance(profile, str):
+                if profile not in profiles:
+                    raise ValueError('link {}: unknown profile {}'.format(idx, profile))
+                profile = profiles[profile]
+            links.append({
+                'a': link['a'],
+                'b': link['b'],
+                'a_ifname': link.get('a_ifname', 'pn{}a'.format(idx)),
+                'b_ifname': link.get('b_ifname', 'pn{}b'.format(idx)),
+                'a_addr': link.get('a_addr'),
+                'b_addr': link.get('b_addr'),
+                'profile': profile or dict(),
+            })
+        topo = cls(nodes=nodes, bridges=bridges, links=links, profiles=profiles)
+        topo.validate()
+        return topo
+
+    def validate(self):
+        if len(set(self.nodes)) != len(self.nodes):
+            raise ValueError('Duplicate node names in topology')
+        if set(self.nodes) & set(self.bridges):
+            raise ValueError('Nodes and bridges must not share names')
+        ifnames = set()
+        for idx, link in enumerate(self.links):
+            for end in ('a', 'b'):
+                if link[end] not in self.nodes and link[end] not in self.bridges:
+                    raise ValueError('link {}: {} is neither a node nor a bridge'.format(idx, link[end]))
+                ifname = link[end + '_ifname']
+                if len(ifname) > 15:
+                    raise ValueError('link {}: interface name {} is longer than 15 characters'.format(idx, ifname))
+                if ifname in ifnames:
+                    raise ValueError('link {}: duplicate interface name {}'.format(idx, ifname))
+                ifnames.add(ifname)
+            for key in link['profile']:
+                if key not in _netem_keys:
+                    raise ValueError('link {}: unsupported profile option {}'.format(idx, key))
+
+    def endpoints(self):
+        """
+        Yield (namespace, ifname, addr, profile) for every veth end.
+
+        namespace is None for ends that stay in the root namespace and join a bridge.
+        """
+        for link in self.links:
+            for end in ('a', 'b'):
+                ns = link[end] if link[end] in self.nodes else None
+                yield ns, link[end + '_ifname'], link[end + '_addr'], link['profile']
+
+
+def load_topology(path):
+    with open(path, encoding='utf-8') as f:
+        return Topology.from_dict(json.load(f))
+
+
+def _netem_line(eth, profile):
+    line = _tc_netem.format(ETH=eth)
+    for key in _netem_keys:
+        value = profile.get(key)
+        if value is not None and str(value).strip() != '':
+            line = ' '.join([line, key, str(value)])
+    return line
+
+
+def _run_parallel(jobs, workers):
+    """
+    Run (tool, lines, netns) batches concurrently, return a list of error messages.
+    """
+    errors = []
+    parent = tracing.current()
+
+    def run(job):
+        with tracing.attach(parent):
+            return job, exec_batch(*job[:3], **job[3])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(run, jobs)
+        for job, (status, msg) in results:
+            if status == 'error':
+                errors.append('{} batch in {}: {}'.format(job[0], job[2] or 'root', str(msg).strip()))
+    return errors
+
+
+def build_topology(topo, workers=16, remote_ssh=False, host=None, username=None, password=None):
+    """
+    Create namespaces, bridges, veth pairs and per-link netem qdiscs.
+
+    Everything in the root namespace goes through a single `ip -batch`, then every
+    namespace is configured by its own `ip -batch`/`tc -batch` pair, in parallel.
+    Return (status, report), report holds the per-phase timings in seconds.
+    """
+    ssh = dict(remote_ssh=remote_ssh, host=host, username=username, password=password)
+    report = {'nodes': len(topo.nodes), 'bridges': len(topo.bridges), 'links': len(topo.links), 'errors': []}
+    start = time.monotonic()
+
+    root_ip = [_ip_netns_add.format(NS=ns) for ns in topo.nodes]
+    for br, stp in topo.bridges.items():
+        root_ip.append(_ip_bridge_add.format(BR=br, STP=1 if stp == 'on' else 0))
+        root_ip.append(_ip_link_up.format(ETH=br))
+    for link in topo.links:
+        a_ns = ' netns {}'.format(link['a']) if link['a'] in topo.nodes else ''
+        b_ns = ' netns {}'.format(link['b']) if link['b'] in topo.nodes else ''
+        root_ip.append(_ip_veth_add.format(A=link['a_ifname'], A_NS=a_ns, B=link['b_ifname'], B_NS=b_ns))
+        for end in ('a', 'b'):
+            if link[end] in topo.bridges:
+                root_ip.append(_ip_link_master.format(ETH=link[end + '_ifname'], BR=link[end]))
+    status, msg = exec_batch('ip', root_ip, **ssh)
+    if status == 'error':
+        report['errors'].append('ip batch in root: {}'.format(str(msg).strip()))
+    phase = time.monotonic()
+    report['root_seconds'] = round(phase - start, 4)
+
+    ns_ip = dict((ns, [_ip_link_up.format(ETH='lo')]) for ns in topo.nodes)
+    ns_tc = dict((ns, []) for ns in topo.nodes)
+    root_tc = []
+    for ns, ifname, addr, profile in topo.endpoints():
+        if ns is not None:
+            ns_ip[ns].append(_ip_link_up.format(ETH=ifname))
+            if addr:
+                ns_ip[ns].append(_ip_addr_add.format(ADDR=addr, ETH=ifname))
+        if profile:
+            (ns_tc[ns] if ns is not None else root_tc).append(_netem_line(ifname, profile))
+
+    report['errors'].extend(_run_parallel([('ip', ns_ip[ns], ns, ssh) for ns in topo.nodes], workers))
+    report['namespace_seconds'] = round(time.monotonic() - phase, 4)
+    phase = time.monotonic()
+
+    jobs = [('tc', ns_tc[ns], ns, ssh) for ns in topo.nodes if ns_tc[ns]]
+    if root_tc:
+        jobs.append(('tc', root_tc, None, ssh))
+    report['errors'].extend(_run_parallel(jobs, workers))
+    report['qdisc_seconds'] = round(time.monotonic() - phase, 4)
+
+    report['build_seconds'] = round(time.monotonic() - start, 4)
+    logger.info('Topology built: {} nodes, {} bridges, {} links in {}s'.format(
+        report['nodes'], report['bridges'], report['links'], report['build_seconds']))
+    return ('error' if report['errors'] else 'success'), report
+
+
+def destroy_topology(topo, remote_ssh=False, host=None, username=None, password=None):
+    """
+    Remove everything created by `build_topology` in a single `ip -batch`.
+
+    Deleting a namespace also deletes the veth ends inside it, and their peers.
+    """
+    report = {'nodes': len(topo.nodes), 'bridges': len(topo.bridges), 'links': len(topo.links), 'errors': []}
+    start = time.monotonic()
+    lines = []
+    for link in topo.links:
+        # bridge-to-bridge pairs have no namespace to take them down, one end is enough
+        if link['a'] in topo.bridges and link['b'] in topo.bridges:
+            lines.append(_ip_link_del.format(ETH=link['a_ifname']))
+    lines.extend(_ip_link_del.format(ETH=br) for br in topo.bridges)
+    lines.extend(_ip_netns_del.format(NS=ns) for ns in topo.nodes)
+    status, msg = exec_batch('ip', lines, remote_ssh=remote_ssh, host=host, username=username, password=password)
+    if status == 'error':
+        report['errors'].append('ip batch in root: {}'.format(str(msg).strip()))
+    report['teardown_seconds'] = round(time.monotonic() - start, 4)
+    logger.info('Topology removed: {} nodes, {} bridges, {} links in {}s'.format(
+        report['nodes'], report['bridges'], report['links'], report['teardown_seconds']))
+    return ('error' if report['errors'] else 'success'), report
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import random
+import itertools
+import threading
+from collections import deque
+from functools import wraps
+from contextlib import contextmanager
+
+
+_config = {'enabled': False, 'sample_rate': 1.0, 'export_path': None}
+_recent = deque(maxlen=100)
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+class _NoopSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_noop = _NoopSpan()
+
+
+class Trace:
+
+    def __init__(self, name):
+        self.trace_id = next(_ids)
+        self.name = name
+        self.wall_time = time.time()
+        self.spans = []
+
+
+class Span:
+
+    def __init__(self, trace, name, parent_id, attrs):
+        self.trace = trace
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.thread = threading.get_ident()
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        _stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = time.monotonic()
+        _stack().pop()
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self.attrs['error'] = repr(exc_val)
+        self.trace.spans.append(self)
+        if self.parent_id is None:
+            _finish(self.trace)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+def configure(enabled=True, sample_rate=None, keep=None, export_path=None):
+    """
+    Turn tracing on or off. `sample_rate` is the fraction of traces kept (0-1), `keep` how many
+    finished traces `recent` remembers, finished traces are also appended to `export_path`
+    (Chrome trace events if it ends with .json, JSON lines otherwise).
+    """
+    global _recent
+    with _lock:
+        _config['enabled'] = enabled
+        if sample_rate is not None:
+            _config['sample_rate'] = sample_rate
+        if keep is not None:
+            _recent = deque(_recent, maxlen=keep)
+        if export_path is not None:
+            _config['export_path'] = export_path
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def trace(name, **attrs):
+    """
+    Start a sampled trace, or a nested span when this thread is already tracing.
+    """
+    if getattr(_local, 'stack', None):
+        return span(name, **attrs)
+    if not _config['enabled'] or random.random() >= _config['sample_rate']:
+        return _noop
+    return Span(Trace(name), name, None, attrs)
+
+
+def span(name, **attrs):
+    """
+    A child of the current span, costs one attribute lookup when this thread is not tracing.
+    """
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return _noop
+    return Span(stack[-1].trace, name, stack[-1].span_id, attrs)
+
+
+def current():
+    """
+    The innermost open span of this thread, to hand over to worker threads with `attach`.
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def attach(parent):
+    """
+    Make spans opened by this thread children of `parent`, a span from another thread.
+    """
+    if parent is None:
+        yield
+        return
+    stack = _stack()
+    stack.append(parent)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def traced(name=None):
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not getattr(_local, 'stack', None):
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _finish(t):
+    t.spans.sort(key=lambda s: s.start)
+    with _lock:
+        _recent.append(t)
+        path = _config['export_path']
+    if path:
+        export(t, path)
+
+
+def recent(limit=None):
+    with _lock:
+        traces = list(_recent)
+    return traces[-limit:] if limit else traces
+
+
+def to_dict(t):
+    origin = t.spans[0].start if t.spans else 0
+    return {
+        'trace_id': t.trace_id,
+        'name': t.name,
+        'time': t.wall_time,
+        'duration_ms': round(t.spans[0].duration * 1000, 3) if t.spans else 0,
+        'spans': [_span_dict(s, origin) for s in t.spans],
+    }
+
+
+def _span_dict(s, origin):
+    return {
+        'trace_id': s.trace.trace_id,
+        'span_id': s.span_id,
+        'parent_id': s.parent_id,
+        'name': s.name,
+        'start_ms': round((s.start - origin) * 1000, 3),
+        'duration_ms': round(s.duration * 1000, 3),
+        'attrs': s.attrs,
+    }
+
+
+def to_jsonl(traces):
+    lines = []
+    for t in traces:
+        origin = t.spans[0].start if t.spans else 0
+        lines.extend(json.dumps(_span_dict(s, origin), default=str) for s in t.spans)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def to_chrome_events(traces):
+    """
+    Complete ("X") events for chrome://tracing or Perfetto, one process per trace.
+    """
+    events = []
+    for t in traces:
+        origin = t.spans[0].start if t.spans else 0
+        for s in t.spans:
+            events.append({
+                'name': s.name,
+                'ph': 'X',
+                'ts': round((t.wall_time + s.start - origin) * 1e6),
+                'dur': round(s.duration * 1e6),
+                'pid': t.trace_id,
+                'tid': s.thread,
+                'args': s.attrs,
+            })
+    return events
+
+
+def export(t, path):
+    with _lock:
+        if path.endswith('.json'):
+            # the trace event array format allows leaving out the closing bracket, so events can be appended
+            with open(path, 'a', encoding='utf-8') as f:
+                if f.tell() == 0:
+                    f.write('[\n')
+                for event in to_chrome_events([t]):
+                    f.write(json.dumps(event, default=str) + ',\n')
+        else:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(to_jsonl([t]))
+
+
+def format_breakdown(t):
+    """
+    An indented tree of spans with their total and self time, for printing.
+    """
+    children = dict()
+    for s in t.spans:
+        children.setdefault(s.parent_id, []).append(s)
+    lines = []
+
+    def walk(s, depth):
+        inner = sum(c.duration for c in children.get(s.span_id, []))
+        label = ' '.join([s.name] + ['{}={}'.format(k, v) for k, v in s.attrs.items()])
+        lines.append('{:>10.2f}ms {:>10.2f}ms  {}{}'.format(
+            s.duration * 1000, max(s.duration - inner, 0) * 1000, '  ' * depth, label))
+        for c in children.get(s.span_id, []):
+            walk(c, depth + 1)
+
+    lines.append('{:>12} {:>12}  {}'.format('total', 'self', 'span'))
+    for root in children.get(None, []):
+        walk(root, 0)
+    return '\n'.join(lines)
@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
+import math
+import time
+import tempfile
 import atexit
 from functools import wraps
 
-from flask import Flask, request, jsonify, Blueprint
+from flask import Flask, Response, request, jsonify, Blueprint
 from .pynetem import *
+from . import stats
+from . import distribution as dist
+from . import tracing
 
 import netifaces
 
 
 interfaces = netifaces.interfaces()
 api = Blueprint('pynetem', __name__)
+stats_store = None
+request_timeout = None
 
 
 def tear_down():
@@ -30,22 +38,32 @@ def create_app():
 def format_response(func):
     @wraps(func)
     def formatter(*args, **kwargs):
-        p = func(*args, **kwargs)
+        with tracing.trace(request.path, method=request.method, eth=request.args.get('eth')) as span:
+            if request_timeout:
+                with deadline(request_timeout):
+                    p = func(*args, **kwargs)
+            else:
+                p = func(*args, **kwargs)
+            span.set(code=p[-1])
         if len(p) == 3:
             status, msg, code = p
             res = None
         else:
             status, msg, res, code = p
-        _response = {
-            "status": status,
-            "msg": msg,
-            "res": res,
-            "code": code
-        }
-        return _response, code
+        return envelope(status, msg, res, code)
     return formatter
 
 
+def envelope(status, msg, res, code):
+    _response = {
+        "status": status,
+        "msg": msg,
+        "res": res,
+        "code": code
+    }
+    return _response, code
+
+
 @api.route('/listInterfaces', methods=['GET'])
 def list_interfaces():
     return jsonify({'status': 'success', 'interfaces': interfaces})
@@ -72,7 +90,11 @@ def get_demo():
             'Format for the options can be found here: https://man7.org/linux/man-pages/man8/tc-netem.8.html.  '
             'And for TBF rate options: https://man7.org/linux/man-pages/man8/tc-tbf.8.html',
         'otherAPIs': ['[GET/DELETE] /pynetem/clear?eth=eth0 -- clear all rules',
-                      '[GET] /pynetem/listInterfaces -- list all interfaces of host']
+                      '[GET] /pynetem/listInterfaces -- list all interfaces of host',
+                      '[POST] /pynetem/distribution -- build a delay distribution from samples in the body',
+                      '[GET] /pynetem/stats/history?eth=eth0&from=&to=&step= -- qdisc and interface counters over time',
+                      '[GET] /pynetem/stats/exec -- command timeouts and queue wait times',
+                      '[GET] /pynetem/traces/recent?format=json|jsonl|chrome&limit=20 -- recent request traces']
     }
     return jsonify(demo)
 
@@ -108,6 +130,26 @@ def get_rules():
     return status, msg, 200
 
 
+@tracing.traced('validate')
+def check_rules(delay, distribution, reorder, netem_rate, rate, buffer, limit, cidr):
+    """
+    Return why these /setRules values are rejected, or None.
+    """
+    if distribution and not delay:
+        return 'Cannot use distribution without delay'
+    if distribution and len(delay.split(' ')) == 1:
+        return 'distribution specified but no latency and jitter values'
+    if distribution and not dist.is_known_distribution(distribution):
+        return 'distribution must be normal/pareto/paretonormal, a table from /pynetem/distribution, or set it None'
+    if reorder and not delay:
+        return 'Cannot use reorder without delay'
+    if rate and netem_rate:
+        return 'Cannot use rate (TBF) and netem_rate together'
+    if not rate and (buffer or limit or cidr):
+        return 'Cannot use buffer, limit or dst without rate'
+    return None
+
+
 @api.route('/setRules', methods=['POST'])
 @format_response
 def set_rules():
@@ -137,24 +179,9 @@ def set_rules():
     limit = data.get('limit')
     cidr = data.get('dst')
 
-    if distribution and not delay:
-        status, msg = 'error', 'Cannot use distribution without delay'
-        return status, msg, 210
-    if distribution and len(delay.split(' ')) == 1:
-        status, msg = 'error', 'distribution specified but no latency and jitter values'
-        return status, msg, 210
-    if distribution and distribution not in ['normal', 'pareto', 'paretonormal', '', None]:
-        status, msg = 'error', 'distribution must be normal/pareto/paretonormal, or set it None'
-        return status, msg, 210
-    if reorder and not delay:
-        status, msg = 'error', 'Cannot use reorder without delay'
-        return status, msg, 210
-    if rate and netem_rate:
-        status, msg = 'error', 'Cannot use rate (TBF) and netem_rate together'
-        return status, msg, 210
-    if not rate and (buffer or limit or cidr):
-        status, msg = 'error', 'Cannot use buffer, limit or dst without rate'
-        return status, msg, 210
+    msg = check_rules(delay, distribution, reorder, netem_rate, rate, buffer, limit, cidr)
+    if msg:
+        return 'error', msg, 210
 
     netem = dict()
     netem['delay'] = delay
@@ -187,6 +214,84 @@ def set_rules():
     return status, msg, 200
 
 
+@api.route('/distribution', methods=['POST'])
+@format_response
+def add_distribution():
+    fd, path = tempfile.mkstemp(prefix='pynetem-samples-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for block in iter(lambda: request.stream.read(1024 * 1024), b''):
+                f.write(block)
+        name, dist_path, meta = dist.build_table(path)
+    except (OSError, ValueError) as e:
+        status, msg = 'error', str(e)
+        return status, msg, 210
+    finally:
+        os.remove(path)
+    status, msg = dist.install_table(name, dist_path)
+    if status == 'error':
+        return status, msg, 210
+    res = dict(meta)
+    res['delay'] = '{:.3f}ms {:.3f}ms'.format(meta['mean'], meta['std'])
+    return status, msg, res, 200
+
+
+@api.route('/stats/history', methods=['GET'])
+@format_response
+def stats_history():
+    if stats_store is None:
+        status, msg = 'error', 'Statistics are not being recorded, start the server with "--stats"'
+        return status, msg, 210
+    eth = request.args.get('eth')
+    if not eth:
+        status, msg = 'error', 'Miss parameter: eth'
+        return status, msg, 210
+    if eth not in interfaces:
+        status, msg = 'error', '{} not in this host'.format(eth)
+        return status, msg, 210
+    try:
+        end = float(request.args.get('to', time.time()))
+        start = float(request.args.get('from', end - 600))
+        step = float(request.args.get('step', 1))
+    except ValueError:
+        status, msg = 'error', 'from, to and step must be numbers (from/to in epoch seconds)'
+        return status, msg, 210
+    if not all(math.isfinite(v) for v in (start, end, step)):
+        status, msg = 'error', 'from, to and step must be finite numbers'
+        return status, msg, 210
+    if step <= 0 or end <= start:
+        status, msg = 'error', 'step must be positive and from must be earlier than to'
+        return status, msg, 210
+    if (end - start) / step > stats._max_buckets:
+        status, msg = 'error', 'Too many points, use a step of at least {}s'.format((end - start) / stats._max_buckets)
+        return status, msg, 210
+    res = stats_store.query(eth, start, end, step)
+    return 'success', None, res, 200
+
+
+@api.route('/stats/exec', methods=['GET'])
+@format_response
+def stats_exec():
+    return 'success', None, exec_stats(), 200
+
+
+@api.route('/traces/recent', methods=['GET'])
+def traces_recent():
+    fmt = request.args.get('format', 'json')
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return envelope('error', 'limit must be an integer', None, 210)
+    if limit < 1:
+        return envelope('error', 'limit must be at least 1', None, 210)
+    traces = tracing.recent(limit)
+    if fmt == 'chrome':
+        return jsonify({'traceEvents': tracing.to_chrome_events(traces), 'displayTimeUnit': 'ms'})
+    if fmt == 'jsonl':
+        return Response(tracing.to_jsonl(traces), mimetype='application/x-ndjson')
+    return envelope('success', None, [tracing.to_dict(t) for t in traces], 200)
+
+
 @api.route('/brctl/addbr', methods=['POST'])
 @format_response
 def add_bridge():
@@ -248,5 +353,12 @@ def add_if_to_br():
 
 
 def start(options):
+    global stats_store, request_timeout
     app = create_app()
+    request_timeout = options.request_timeout
+    if options.trace_sample:
+        tracing.configure(enabled=True, sample_rate=options.trace_sample, export_path=options.trace_export)
+    if options.stats:
+        stats_store = stats.StatsStore()
+        stats.StatsSampler(stats_store, interfaces).start()
     app.run(host='0.0.0.0', port=options.port, threaded=True, debug=False)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+
+import numpy as np
+import pytest
+
+from pynetem import distribution
+
+
+def _write(tmp_path, content, name='samples.txt'):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_read_samples_any_whitespace(tmp_path):
+    path = _write(tmp_path, b'1 2.5\n3e1\t-4\r\n  5\n')
+    assert distribution.read_samples(path).tolist() == [1, 2.5, 30, -4, 5]
+
+
+def test_read_samples_numbers_split_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(distribution, '_read_block', 7)
+    values = [round(0.001 * i * i, 3) for i in range(200)]
+    path = _write(tmp_path, ' '.join(str(v) for v in values).encode())
+    assert distribution.read_samples(path).tolist() == values
+
+
+def test_read_samples_rejects_garbage(tmp_path):
+    path = _write(tmp_path, b'1 2 3ms 4\n')
+    with pytest.raises(ValueError):
+        distribution.read_samples(path)
+
+
+def test_make_table_layout():
+    rng = np.random.default_rng(1)
+    samples = rng.normal(50, 5, 100000)
+    table, mean, std = distribution.make_table(samples)
+    assert table.dtype == np.int16
+    assert len(table) == 4096
+    assert abs(mean - 50) < 0.1 and abs(std - 5) < 0.1
+    # standardized inverse CDF scaled by 8192: sorted, centred, one std at the 84th percentile
+    assert np.all(np.diff(table) >= 0)
+    assert abs(int(table[2048])) < 100
+    assert abs(int(table[int(4096 * 0.8413)]) - 8192) < 200
+
+
+def test_make_table_ignores_non_finite_and_rejects_degenerate():
+    table, mean, std = distribution.make_table(np.array([1.0, 3.0, np.nan, np.inf]))
+    assert (mean, std) == (2.0, 1.0)
+    with pytest.raises(ValueError):
+        distribution.make_table(np.array([1.0, np.nan]))
+    with pytest.raises(ValueError):
+        distribution.make_table(np.array([2.0, 2.0, 2.0]))
+
+
+def test_format_table_is_readable_by_tc():
+    table = np.arange(-8, 8, dtype=np.int16)
+    lines = distribution.format_table(table, 'test').splitlines()
+    assert lines[0] == '# test'
+    assert lines[1:] == ['-8 -7 -6 -5 -4 -3 -2 -1', '0 1 2 3 4 5 6 7']
+
+
+def test_build_table_and_cache(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    path = _write(tmp_path, ' '.join(str(i % 17) for i in range(1000)).encode())
+    name, dist_path, meta = distribution.build_table(path, cache_dir=cache_dir)
+    assert distribution._name_re.match(name)
+    assert dist_path == os.path.join(cache_dir, name + '.dist')
+    assert meta['samples'] == 1000
+    assert stat.S_IMODE(os.stat(dist_path).st_mode) == 0o644
+    values = [int(v) for line in open(dist_path) if not line.startswith('#') for v in line.split()]
+    assert len(values) == 4096
+    # nothing but the finished entries is left in the cache directory
+    assert sorted(os.listdir(cache_dir)) == [name + '.dist', name + '.json']
+
+    def fail(path):
+        raise AssertionError('cache miss')
+    monkeypatch.setattr(distribution, 'read_samples', fail)
+    assert distribution.build_table(path, cache_dir=cache_dir) == (name, dist_path, meta)
+
+    other = _write(tmp_path, b'1 2 3', name='other.txt')
+    with pytest.raises(AssertionError):
+        distribution.build_table(other, cache_dir=cache_dir)
+
+
+def test_is_known_distribution_rejects_non_strings():
+    assert distribution.is_known_distribution('normal')
+    assert not distribution.is_known_distribution(5)
+    assert not distribution.is_known_distribution(None)
+    assert not distribution.is_known_distribution('uniform')
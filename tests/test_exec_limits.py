@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from pynetem import pynetem
+
+
+@pytest.fixture(autouse=True)
+def limits():
+    yield
+    pynetem.set_exec_limits(timeout=60, max_concurrency=32, max_per_host=8)
+
+
+def test_slow_command_is_killed_at_the_timeout():
+    pynetem.set_exec_limits(timeout=0.3)
+    before = pynetem.exec_stats()['timeouts']
+    start = time.monotonic()
+    status, msg = pynetem._run_local(['sleep', '5'])
+    assert time.monotonic() - start < 2
+    assert status == 'error' and msg.startswith('Timed out after 0.3s')
+    assert pynetem.exec_stats()['timeouts'] == before + 1
+
+
+def test_deadline_bounds_every_command_and_nests():
+    with pynetem.deadline(0.3):
+        with pynetem.deadline(10):
+            assert pynetem._remaining() <= 0.3
+        assert pynetem._run_local(['sleep', '5'])[0] == 'error'
+        # the budget is spent, the next command does not even start
+        assert pynetem._run_local(['true']) == ('error', 'Timed out after 0.0s: true')
+    assert pynetem._remaining() == 60
+
+
+def test_queue_timeout_when_no_slot_is_free():
+    pynetem.set_exec_limits(timeout=0.2, max_concurrency=1)
+    held = pynetem._acquire_slot(None)
+    before = pynetem.exec_stats()
+    try:
+        status, msg = pynetem.exec_command('true')
+    finally:
+        pynetem._release_slot(held)
+    after = pynetem.exec_stats()
+    assert (status, msg) == ('error', 'Timed out waiting for a free execution slot: true')
+    assert after['queue_timeouts'] == before['queue_timeouts'] + 1
+    assert after['queue_wait_max_seconds'] >= 0.2
+    assert after['in_flight'] == before['in_flight'] - 1
+    assert pynetem.exec_command('true') == ('success', '')
+
+
+def test_per_host_limit_only_applies_to_remote_hosts():
+    pynetem.set_exec_limits(timeout=0.1, max_concurrency=4, max_per_host=1)
+    local = [pynetem._acquire_slot(None) for _ in range(3)]
+    remote = pynetem._acquire_slot('10.0.0.1')
+    try:
+        assert None not in local and remote is not None
+        assert pynetem._acquire_slot('10.0.0.1') is None
+    finally:
+        for slots in local + [remote]:
+            pynetem._release_slot(slots)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import json
+
+from pynetem import stats
+
+
+def _qdisc(dev, kind, handle, **counters):
+    qdisc = {'kind': kind, 'handle': handle, 'dev': dev, 'root': True, 'options': {},
+             'bytes': 0, 'packets': 0, 'drops': 0, 'overlimits': 0, 'requeues': 0, 'backlog': 0, 'qlen': 0}
+    qdisc.update(counters)
+    return qdisc
+
+
+def test_parse_qdisc_stats_exact_backlog():
+    # the text output would print this backlog as "2Kb"
+    output = json.dumps([
+        _qdisc('eth0', 'netem', '8001:', bytes=1234, packets=10, drops=1, overlimits=2, requeues=3, backlog=2048, qlen=2),
+        _qdisc('lo', 'noqueue', '0:'),
+    ])
+    rows = list(stats.parse_qdisc_stats(output))
+    assert rows == [
+        ('eth0', 'qdisc netem 8001:', [1234, 10, 1, 2, 3, 2048, 2]),
+        ('lo', 'qdisc noqueue 0:', [0, 0, 0, 0, 0, 0, 0]),
+    ]
+
+
+def test_parse_qdisc_stats_skips_entries_without_counters():
+    output = json.dumps([{'kind': 'netem', 'handle': '8001:', 'dev': 'eth0'}, _qdisc('eth1', 'tbf', '10:', bytes=5)])
+    assert [row[0] for row in stats.parse_qdisc_stats(output)] == ['eth1']
+    assert list(stats.parse_qdisc_stats('')) == []
+
+
+def _history():
+    history = stats.SeriesHistory(stats._qdisc_fields, stats._qdisc_gauges, tiers=[(0.1, 60), (1, 600)])
+    for i in range(3000):
+        # 1000 bytes per sample at 10 samples per second, backlog cycling 0..6
+        history.append(1000.0 + i * 0.1, [i * 1000, i, 0, 0, 0, i % 7, 0])
+    return history
+
+
+def test_query_uses_finest_tier_covering_window():
+    q = _history().query(1250.0, 1260.0, 1)
+    assert q['resolution'] == 0.1
+    assert q['samples'] == 101
+    assert len(q['series']['bytes']) == 10
+    assert q['series']['bytes_per_sec'][0] is None
+    for rate in q['series']['bytes_per_sec'][1:]:
+        assert abs(rate - 10000) < 1e-6
+    assert q['series']['backlog_bytes'] == [6.0] * 10
+
+
+def test_query_falls_back_to_coarser_tier():
+    q = _history().query(1010.0, 1110.0, 10)
+    assert q['resolution'] == 1
+    # one row per second, stamped with the latest sample of that second
+    assert q['samples'] == 100
+    for rate in q['series']['packets_per_sec'][1:]:
+        assert abs(rate - 10) < 1e-6
+
+
+def test_query_finer_than_covering_tiers():
+    # the 100ms tier only holds the last 60s, the 1s tier covers the window
+    q = _history().query(1010.0, 1110.0, 0.5)
+    assert q['resolution'] == 1
+    assert q['samples'] == 100
+    assert sum(v is not None for v in q['series']['bytes']) == 100
+
+
+def test_query_empty_buckets_are_none():
+    q = _history().query(2000.0, 2010.0, 1)
+    assert q['samples'] == 0
+    assert q['series']['bytes'] == [None] * 10
+    assert q['series']['backlog_bytes'] == [None] * 10
+
+
+def test_coarse_tiers_keep_gauge_peaks():
+    history = stats.SeriesHistory(stats._qdisc_fields, stats._qdisc_gauges, tiers=[(0.1, 60), (1, 600)])
+    for i in range(3000):
+        # a 100 byte backlog spike once per second, between the 1s tier samples
+        history.append(1000.0 + i * 0.1, [i * 1000, i, 0, 0, 0, 100 if i % 10 == 5 else 0, 0])
+    q = history.query(1010.0, 1110.0, 1)
+    assert q['resolution'] == 1
+    assert q['series']['backlog_bytes'] == [100.0] * 100
+    # counters are the last value of each second
+    assert q['series']['bytes'][0] == 109 * 1000
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+
+from pynetem.pynetem import TcBatchSession
+
+
+def _session(stderr, lineno=0):
+    session = TcBatchSession()
+    session.stderr = io.StringIO(stderr)
+    session.lineno = lineno
+    return session
+
+
+def test_success_only_sees_sync_marker():
+    session = _session('Cannot find device "pynetem-sync"\nCommand failed -:2\n')
+    assert session._read_result('qdisc change dev eth0 root netem delay 10ms') == ('success', '')
+    assert session.lineno == 2
+
+
+def test_error_is_mapped_to_its_command():
+    session = _session(
+        'Cannot find device "nosuch"\nCommand failed -:3\n'
+        'Cannot find device "pynetem-sync"\nCommand failed -:4\n'
+        'Cannot find device "pynetem-sync"\nCommand failed -:6\n', lineno=2)
+    status, msg = session._read_result('qdisc add dev nosuch root netem delay 1ms')
+    assert status == 'error'
+    assert msg == 'tc qdisc add dev nosuch root netem delay 1ms: Cannot find device "nosuch"'
+    assert session._read_result('qdisc del dev lo root') == ('success', '')
+
+
+def test_warnings_of_successful_command_are_kept():
+    session = _session('Warning: sch_htb: quantum of class 10001 is big.\n'
+                       'Cannot find device "pynetem-sync"\nCommand failed -:2\n')
+    assert session._read_result('class add dev eth0 parent 1: classid 1:1 htb rate 10gbit') == \
+        ('success', 'Warning: sch_htb: quantum of class 10001 is big.\n')
+
+
+def test_truncated_output_raises():
+    session = _session('Cannot find device "nosuch"\n')
+    with pytest.raises(EOFError):
+        session._read_result('qdisc add dev nosuch root netem delay 1ms')
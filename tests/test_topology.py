@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from pynetem import topology
+
+
+_lab = {
+    'nodes': ['h1', 'h2'],
+    'bridges': ['br0', {'name': 'br1', 'stp': 'on'}],
+    'profiles': {'wan': {'delay': '20ms 5ms', 'loss': '1%'}},
+    'links': [
+        {'a': 'h1', 'b': 'br0', 'profile': 'wan', 'a_addr': '10.0.0.1/24'},
+        {'a': 'h2', 'b': 'br0', 'a_addr': '10.0.0.2/24'},
+        {'a': 'h1', 'b': 'h2', 'a_ifname': 'h1h2', 'b_ifname': 'h2h1', 'profile': {'rate': '1mbit'}},
+        {'a': 'br0', 'b': 'br1'},
+    ],
+}
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def exec_batch(tool, lines, netns=None, **ssh):
+        with lock:
+            calls.append((tool, netns, list(lines)))
+        return 'success', ''
+    monkeypatch.setattr(topology, 'exec_batch', exec_batch)
+    return calls
+
+
+def _topo(**changes):
+    data = dict(_lab)
+    data.update(changes)
+    return topology.Topology.from_dict(data)
+
+
+@pytest.mark.parametrize('changes, error', [
+    ({'links': [{'a': 'h1', 'b': 'br0', 'profile': 'lan'}]}, 'unknown profile lan'),
+    ({'links': [{'a': 'h1', 'b': 'br0', 'profile': {'jitter': '1ms'}}]}, 'unsupported profile option jitter'),
+    ({'links': [{'a': 'h1', 'b': 'h3'}]}, 'h3 is neither a node nor a bridge'),
+    ({'links': [{'a': 'h1', 'b': 'br0', 'a_ifname': 'x'}, {'a': 'h2', 'b': 'br0', 'a_ifname': 'x'}]},
+     'duplicate interface name x'),
+    ({'links': [{'a': 'h1', 'b': 'br0', 'a_ifname': 'a-very-long-name'}]}, 'longer than 15 characters'),
+    ({'nodes': ['h1', 'h1']}, 'Duplicate node names'),
+    ({'nodes': ['h1', 'br0']}, 'must not share names'),
+])
+def test_invalid_topologies(changes, error):
+    with pytest.raises(ValueError, match=error):
+        _topo(**changes)
+
+
+def test_build_batches(batches):
+    status, report = topology.build_topology(_topo(), workers=2)
+    assert status == 'success'
+    assert (report['nodes'], report['bridges'], report['links'], report['errors']) == (2, 2, 4, [])
+    assert batches[0] == ('ip', None, [
+        'netns add h1',
+        'netns add h2',
+        'link add br0 type bridge stp_state 0',
+        'link set dev br0 up',
+        'link add br1 type bridge stp_state 1',
+        'link set dev br1 up',
+        'link add pn0a netns h1 type veth peer name pn0b',
+        'link set dev pn0b master br0 up',
+        'link add pn1a netns h2 type veth peer name pn1b',
+        'link set dev pn1b master br0 up',
+        'link add h1h2 netns h1 type veth peer name h2h1 netns h2',
+        'link add pn3a type veth peer name pn3b',
+        'link set dev pn3a master br0 up',
+        'link set dev pn3b master br1 up',
+    ])
+    # the namespaces run in parallel, so their order is not fixed
+    assert sorted(batches[1:3]) == [
+        ('ip', 'h1', ['link set dev lo up', 'link set dev pn0a up', 'addr add 10.0.0.1/24 dev pn0a',
+                      'link set dev h1h2 up']),
+        ('ip', 'h2', ['link set dev lo up', 'link set dev pn1a up', 'addr add 10.0.0.2/24 dev pn1a',
+                      'link set dev h2h1 up']),
+    ]
+    assert sorted(batches[3:], key=lambda b: str(b[1])) == [
+        ('tc', None, ['qdisc replace dev pn0b root netem delay 20ms 5ms loss 1%']),
+        ('tc', 'h1', ['qdisc replace dev pn0a root netem delay 20ms 5ms loss 1%',
+                      'qdisc replace dev h1h2 root netem rate 1mbit']),
+        ('tc', 'h2', ['qdisc replace dev h2h1 root netem rate 1mbit']),
+    ]
+
+
+def test_build_reports_batch_errors(batches, monkeypatch):
+    def exec_batch(tool, lines, netns=None, **ssh):
+        return ('error', 'RTNETLINK answers: File exists\n') if netns == 'h2' else ('success', '')
+    monkeypatch.setattr(topology, 'exec_batch', exec_batch)
+    status, report = topology.build_topology(_topo())
+    assert status == 'error'
+    assert report['errors'] == ['ip batch in h2: RTNETLINK answers: File exists',
+                                'tc batch in h2: RTNETLINK answers: File exists']
+
+
+def test_destroy_batch(batches):
+    status, report = topology.destroy_topology(_topo())
+    assert status == 'success'
+    assert batches == [('ip', None, [
+        'link del dev pn3a',
+        'link del dev br0',
+        'link del dev br1',
+        'netns del h1',
+        'netns del h2',
+    ])]
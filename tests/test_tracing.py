@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+import pytest
+
+from pynetem import tracing
+
+
+@pytest.fixture(autouse=True)
+def enabled():
+    tracing._recent.clear()
+    tracing.configure(enabled=True, sample_rate=1.0)
+    yield
+    tracing.configure(enabled=False, sample_rate=1.0)
+    tracing._config['export_path'] = None
+    tracing._recent.clear()
+
+
+@tracing.traced()
+def work():
+    with tracing.span('inner'):
+        return 42
+
+
+def _lab_trace():
+    with tracing.trace('root', path='/x') as root:
+        with tracing.span('a'):
+            work()
+        with tracing.span('b', n=1):
+            pass
+    return root.trace
+
+
+def test_nesting_and_parent_ids():
+    t = _lab_trace()
+    assert tracing.recent() == [t]
+    spans = dict((s.name, s) for s in t.spans)
+    assert [s.name for s in t.spans] == ['root', 'a', 'work', 'inner', 'b']
+    assert spans['root'].parent_id is None
+    assert spans['a'].parent_id == spans['root'].span_id
+    assert spans['work'].parent_id == spans['a'].span_id
+    assert spans['inner'].parent_id == spans['work'].span_id
+    assert spans['b'].parent_id == spans['root'].span_id
+    assert spans['b'].attrs == {'n': 1}
+    assert tracing.current() is None
+
+
+def test_nothing_is_recorded_when_disabled_or_not_sampled():
+    tracing.configure(enabled=False)
+    assert tracing.trace('root') is tracing._noop
+    tracing.configure(enabled=True, sample_rate=0)
+    with tracing.trace('root') as root:
+        assert root is tracing._noop
+        assert tracing.span('a') is tracing._noop
+        assert work() == 42
+        assert tracing.current() is None
+    assert tracing.recent() == []
+
+
+def test_span_records_exceptions():
+    with pytest.raises(KeyError):
+        with tracing.trace('root'):
+            with tracing.span('fails'):
+                raise KeyError('eth9')
+    t = tracing.recent(1)[0]
+    assert [s.attrs['error'] for s in t.spans] == ["KeyError('eth9')", "KeyError('eth9')"]
+
+
+def test_attach_across_threads():
+    def worker(parent, i):
+        with tracing.attach(parent):
+            with tracing.span('job', i=i):
+                pass
+        # attach leaves the worker's stack as it found it
+        assert tracing.current() is None
+
+    with tracing.trace('root') as root:
+        threads = [threading.Thread(target=worker, args=(tracing.current(), i)) for i in range(3)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+    jobs = [s for s in root.trace.spans if s.name == 'job']
+    assert sorted(s.attrs['i'] for s in jobs) == [0, 1, 2]
+    assert all(s.parent_id == root.span_id and s.thread != root.thread for s in jobs)
+    # without a parent, attach is a no-op and the worker is not traced
+    with tracing.attach(None):
+        assert tracing.span('job') is tracing._noop
+
+
+def test_recent_limit():
+    for _ in range(3):
+        _lab_trace()
+    assert len(tracing.recent()) == 3
+    assert tracing.recent(2) == tracing.recent()[1:]
+
+
+def _fixed_times(t):
+    # root 0-10ms, a 1-6ms, work 2-5ms, inner 3-4ms, b 7-8ms
+    for s, (start, end) in zip(t.spans, [(0, 10), (1, 6), (2, 5), (3, 4), (7, 8)]):
+        s.start, s.end = 100 + start / 1000.0, 100 + end / 1000.0
+    return t
+
+
+def test_to_jsonl():
+    t = _fixed_times(_lab_trace())
+    rows = [json.loads(line) for line in tracing.to_jsonl([t]).splitlines()]
+    assert [r['name'] for r in rows] == ['root', 'a', 'work', 'inner', 'b']
+    assert rows[0]['attrs'] == {'path': '/x'}
+    assert rows[4] == {'trace_id': t.trace_id, 'span_id': t.spans[4].span_id, 'parent_id': t.spans[0].span_id,
+                       'name': 'b', 'start_ms': 7.0, 'duration_ms': 1.0, 'attrs': {'n': 1}}
+    assert tracing.to_jsonl([]) == ''
+
+
+def test_to_chrome_events():
+    t = _fixed_times(_lab_trace())
+    events = tracing.to_chrome_events([t])
+    assert [(e['name'], e['ph'], e['pid'], e['dur']) for e in events] == [
+        ('root', 'X', t.trace_id, 10000), ('a', 'X', t.trace_id, 5000), ('work', 'X', t.trace_id, 3000),
+        ('inner', 'X', t.trace_id, 1000), ('b', 'X', t.trace_id, 1000)]
+    assert events[1]['ts'] - events[0]['ts'] == 1000
+    assert events[0]['ts'] == round(t.wall_time * 1e6)
+
+
+def test_format_breakdown():
+    t = _fixed_times(_lab_trace())
+    assert tracing.format_breakdown(t).splitlines() == [
+        '       total         self  span',
+        '     10.00ms       4.00ms  root path=/x',
+        '      5.00ms       2.00ms    a',
+        '      3.00ms       2.00ms      work',
+        '      1.00ms       1.00ms        inner',
+        '      1.00ms       1.00ms    b n=1',
+    ]
+
+
+def test_export(tmp_path):
+    jsonl = str(tmp_path / 'traces.jsonl')
+    chrome = str(tmp_path / 'traces.json')
+    tracing.configure(export_path=jsonl)
+    _lab_trace()
+    _lab_trace()
+    assert len(open(jsonl).read().splitlines()) == 10
+    tracing.configure(export_path=chrome)
+    _lab_trace()
+    content = open(chrome).read()
+    assert content.startswith('[\n')
+    # the unterminated array is valid trace event format, close it to check the events
+    assert len(json.loads(content.rstrip(',\n') + ']')) == 5